@@ -1,11 +1,26 @@
 import telebot
+from telebot import apihelper
 import yt_dlp
+from yt_dlp.utils import remove_terminal_sequences
 import os
+import re
+import json
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
 from pathlib import Path
 import logging
-from urllib.parse import urlparse
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import ffmpeg
+from diskcache import Cache
+from flask import Flask, request
 
 # Load environment variables from .env file
 load_dotenv()
@@ -26,41 +41,170 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 if not BOT_TOKEN:
     raise ValueError("No BOT_TOKEN found in environment variables!")
 
-bot = telebot.TeleBot(BOT_TOKEN)
+# Optional self-hosted Bot API server (e.g. http://localhost:8081), run with
+# --local so it can read uploads straight from our disk
+LOCAL_BOT_API = os.getenv('LOCAL_BOT_API')
+if LOCAL_BOT_API:
+    apihelper.API_URL = LOCAL_BOT_API.rstrip('/') + "/bot{0}/{1}"
+
+# Handlers only queue jobs on EXEC, so run them inline instead of in
+# telebot's own worker threads (which don't survive gunicorn's fork)
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
+
+# Public HTTPS base URL Telegram pushes updates to (webhook mode)
+PUBLIC_URL = os.getenv('PUBLIC_URL')
+app = Flask(__name__)
 
 # Create downloads directory
 DOWNLOAD_DIR = Path("downloads")
 DOWNLOAD_DIR.mkdir(exist_ok=True)
 
+# Run downloads in the background so one user's job doesn't block the rest
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '4'))
+EXEC = ThreadPoolExecutor(max_workers=BOT_WORKERS)
+# ffmpeg is CPU-bound, limit concurrent encodes to half the cores
+ENCODE_SLOTS = threading.BoundedSemaphore(max(1, (os.cpu_count() or 2) // 2))
+# Status edits are sent from their own threads so jobs never wait on Telegram
+STATUS_EXEC = ThreadPoolExecutor(max_workers=4)
+# Last (time, text) sent per status message, used to coalesce edits
+_last_status = {}
+# Newest not-yet-sent text per status message, and the messages a status
+# thread is currently sending, so only one thread edits a message at a time
+_pending_status = {}
+_sending_status = set()
+_status_lock = threading.Lock()
+
+# yt-dlp options shared by every download
+YDL_OPTS = {
+    # Only pick formats that fit Telegram's 50MB limit, so oversized
+    # videos are rejected before anything is downloaded. H.264 comes first
+    # (yt-dlp would otherwise rank AV1/VP9 above it) so it can be sent as-is.
+    'format': ('bestvideo[height<=1080][vcodec^=avc1][filesize<?45M]+bestaudio[ext=m4a][filesize<?5M]'
+               '/bestvideo[height<=1080][ext=mp4][filesize<?45M]+bestaudio[ext=m4a][filesize<?5M]'
+               '/best[height<=1080][ext=mp4][filesize<?50M]'
+               '/bestvideo[height<=1080][filesize<?45M]+bestaudio[filesize<?5M]'
+               '/best[filesize<?50M]'),
+    # Reject long videos before format selection, so they get the "too long"
+    # message rather than failing the size filters above
+    'match_filter': yt_dlp.utils.match_filter_func('duration <=? 600'),
+    'merge_output_format': 'mp4',
+    # watch?v=X&list=... links download just the video, not the playlist
+    'noplaylist': True,
+    # Let the merger write faststart MP4s so they can be sent as-is
+    'postprocessor_args': {'merger': ['-movflags', '+faststart']},
+    # Keep player JS/signature data between downloads
+    'cachedir': '.ytcache',
+    'extractor_args': {'youtube': {'player_skip': ['configs']}},
+}
+# Ready YoutubeDL instances, one per worker, so jobs don't pay yt-dlp's
+# startup cost each time. The job currently using an instance (for
+# progress reports) is tracked per thread.
+YDL_POOL = queue.Queue()
+_job = threading.local()
+
+# Cache video metadata so repeated links skip yt-dlp's extraction requests
+meta_cache = Cache('.ytmeta', size_limit=200 * 1024 * 1024)
+META_TTL = 5 * 60 * 60  # Stream URLs in the metadata expire after ~6h
+
+# YouTube link patterns, compiled once since every message is checked
+YOUTUBE_URL_RE = re.compile(r'(?i)\b(?:https?://)?(?:www\.|m\.)?(?:youtube\.com/\S+|youtu\.be/\S+)')
+VIDEO_ID_RE = re.compile(r'(?:v=|youtu\.be/|shorts/)([A-Za-z0-9_-]{11})')
+
+# Filename cleanup: a C-level translate table drops unsafe ASCII, the regex
+# only runs for titles with non-ASCII characters left
+FILENAME_TRANS = str.maketrans('', '', ''.join(
+    c for c in map(chr, range(128)) if not (c.isalnum() or c in ' -_')
+))
+UNSAFE_FILENAME_RE = re.compile(r'[^\w \-]')
+
 def is_valid_youtube_url(url):
     """Validate if the given URL is a YouTube URL"""
-    try:
-        parsed = urlparse(url)
-        return any(
-            domain in parsed.netloc
-            for domain in ['youtube.com', 'youtu.be', 'm.youtube.com', 'www.youtube.com']
-        )
-    except Exception:
-        return False
+    return bool(YOUTUBE_URL_RE.search(url))
+
+def get_video_info(ydl, url):
+    """Fetch video metadata, reusing cached results for repeated videos"""
+    match = VIDEO_ID_RE.search(url)
+    key = match.group(1) if match else url
+    info = meta_cache.get(key)
+    if info is None:
+        try:
+            info = ydl.extract_info(url, download=False)
+        except yt_dlp.utils.DownloadError as e:
+            # yt-dlp has no dedicated error type for this, so match on its
+            # message text (fragile, recheck when upgrading yt-dlp)
+            if 'Requested format is not available' in str(e):
+                raise ValueError("Video is too large for Telegram (>50MB). Try a shorter video.") from e
+            raise
+        if info:
+            info = ydl.sanitize_info(info)
+            # Only single videos are safe to cache under the video id
+            if info.get('_type', 'video') == 'video':
+                meta_cache.set(key, info, expire=META_TTL)
+    return info
 
 def get_safe_filename(title):
     """Convert title to safe filename"""
-    return "".join(x for x in title if x.isalnum() or x in (' ', '-', '_')).rstrip()
+    safe = title.translate(FILENAME_TRANS)
+    if not safe.isascii():
+        safe = UNSAFE_FILENAME_RE.sub('', safe)
+    return safe.rstrip()
+
+def is_h264_mp4(info):
+    """Check if yt-dlp's output is already H.264/AAC MP4 (no re-encode needed)"""
+    formats = info.get('requested_formats') or [info]
+    vcodec = next((f['vcodec'] for f in formats if f.get('vcodec') not in (None, 'none')), '')
+    acodec = next((f['acodec'] for f in formats if f.get('acodec') not in (None, 'none')), '')
+    return (info.get('ext') == 'mp4'
+            and vcodec.startswith('avc1')
+            and acodec.startswith('mp4a'))
 
-def process_video(input_file, output_file):
-    """Process video with ffmpeg-python for better quality"""
+def video_encoder_args(preset):
+    """Pick H.264 encoder settings: NVENC on the GPU if enabled, else libx264"""
+    if os.getenv('H264_NVENC') == '1':
+        return {
+            'vcodec': 'h264_nvenc',  # NVIDIA hardware encoder
+            'preset': 'p4',          # Balanced NVENC preset
+            'tune': 'hq',
+            'rc': 'vbr',
+            'cq': 23,                # Constant quality target
+            'b:v': 0,
+        }
+    return {
+        'vcodec': 'libx264',         # H.264 codec
+        'crf': 18,                   # High quality (18-23 is very good)
+        'preset': preset,            # veryfast: much faster, slightly larger
+        'threads': 0,                # One thread per core
+        # Split each frame across cores and keep the lookahead short so
+        # short clips don't leave cores idle waiting on frame threads
+        'x264-params': 'sliced-threads=1:sync-lookahead=0:rc-lookahead=10',
+    }
+
+def process_video(info, output_file, preset=os.getenv('X264_PRESET', 'veryfast')):
+    """Download with yt-dlp and process with ffmpeg-python in one pipe (no raw file on disk)"""
+    yt_proc = None
+    ff_proc = None
     try:
-        # Input video stream
-        stream = ffmpeg.input(input_file)
+        # Hand yt-dlp the metadata we already have so it doesn't extract again
+        info_file = Path(output_file).with_suffix('.info.json')
+        info_file.write_text(json.dumps(info))
+        yt_proc = subprocess.Popen(
+            # Same interpreter (and yt-dlp version) as the one that wrote the info
+            [sys.executable, '-m', 'yt_dlp', '--quiet', '--cache-dir', YDL_OPTS['cachedir'],
+             '--load-info-json', str(info_file),
+             '-f', info['format_id'], '-o', '-',
+             # MKV holds any codec mix; MP4 output on stdout becomes MPEG-TS,
+             # which ffmpeg can't reliably read AV1 from
+             '--merge-output-format', 'mkv'],
+            stdout=subprocess.PIPE
+        )
+
+        # Input video stream from yt-dlp's stdout
+        stream = ffmpeg.input('pipe:0')
         
         # Apply video processing
         stream = ffmpeg.output(stream, output_file,
             # Video settings
-            vcodec='libx264',        # H.264 codec
-            crf=18,                  # High quality (18-23 is very good)
-            preset='slow',           # Slower encoding = better quality
-            profile='high',          # High profile
-            level='4.1',            # Compatibility level
+            **video_encoder_args(preset),
             pix_fmt='yuv420p',      # Standard pixel format
             # Audio settings
             acodec='aac',           # AAC audio codec
@@ -68,49 +212,119 @@ def process_video(input_file, output_file):
             # Additional options
             movflags='+faststart',   # Enable fast streaming
             **{'max_muxing_queue_size': '1024'} # Prevent muxing errors
-        )
+        ).global_args('-loglevel', 'error', '-nostats')  # Only log errors, no progress lines
         
-        # Run ffmpeg
-        ffmpeg.run(stream, overwrite_output=True, capture_stdout=True, capture_stderr=True)
+        # Run ffmpeg, feeding it the download as it arrives
+        ff_proc = ffmpeg.run_async(stream, pipe_stdin=True, pipe_stderr=True, overwrite_output=True)
+        # Keep only the last lines of ffmpeg's output for error reporting
+        stderr_tail = deque(maxlen=64)
+        stderr_reader = threading.Thread(target=stderr_tail.extend, args=(ff_proc.stderr,), daemon=True)
+        stderr_reader.start()
+        input_complete = True
+        try:
+            shutil.copyfileobj(yt_proc.stdout, ff_proc.stdin)
+            ff_proc.stdin.close()
+        except BrokenPipeError:
+            # ffmpeg quit early, its stderr tail below says why
+            input_complete = False
+
+        ff_proc.wait()
+        stderr_reader.join()
+        ffmpeg_log = b''.join(stderr_tail).decode(errors='replace')
+        # yt-dlp's output ended: if yt-dlp failed, ffmpeg only saw empty or
+        # truncated input, so report yt-dlp first
+        if input_complete and yt_proc.wait() != 0:
+            logger.error(f"yt-dlp exited with code {yt_proc.returncode}, FFmpeg output: {ffmpeg_log}")
+            return False
+        if ff_proc.returncode != 0:
+            logger.error(f"FFmpeg exited with code {ff_proc.returncode}: {ffmpeg_log}")
+            return False
         return True
-    except ffmpeg.Error as e:
-        logger.error(f"FFmpeg error: {e.stderr.decode()}")
-        return False
     except Exception as e:
         logger.error(f"Processing error: {str(e)}")
         return False
+    finally:
+        for proc in (yt_proc, ff_proc):
+            if proc and proc.poll() is None:
+                proc.kill()
+                proc.wait()
+
+def _send_status(key):
+    """Send the newest pending text for a status message until none is left
+
+    Texts queued while an edit is in flight replace each other, so a slow
+    Telegram call only ever leaves the latest status to send
+    """
+    while True:
+        with _status_lock:
+            text = _pending_status.pop(key, None)
+            if text is None:
+                _sending_status.discard(key)
+                return
+        try:
+            bot.edit_message_text(text, *key)
+        except Exception as e:
+            logger.error(f"Error updating status: {e}")
+
+def set_status(chat_id, message_id, text, throttle=False):
+    """Queue a status message edit without blocking the caller
+
+    Edits that wouldn't change the text are skipped, and with throttle=True
+    so are edits within a second of the previous one (progress updates)
+    """
+    key = (chat_id, message_id)
+    now = time.monotonic()
+    with _status_lock:
+        last_time, last_text = _last_status.get(key, (0.0, None))
+        if text == last_text or (throttle and now - last_time < 1.0):
+            return
+        _last_status[key] = (now, text)
+        _pending_status[key] = text
+        if key in _sending_status:
+            return
+        _sending_status.add(key)
+    STATUS_EXEC.submit(_send_status, key)
+
+def report_progress(d):
+    """yt-dlp progress hook, reports download progress on the job's status message"""
+    status = getattr(_job, 'status', None)
+    if d['status'] != 'downloading' or not status:
+        return
+    progress = remove_terminal_sequences(f"{d.get('_percent_str', '')} @ {d.get('_speed_str', '')}")
+    set_status(*status,
+               f"⏳ Downloading video in 1080p... {progress.strip()}",
+               throttle=True)
+
+for _ in range(BOT_WORKERS):
+    YDL_POOL.put(yt_dlp.YoutubeDL({**YDL_OPTS, 'progress_hooks': [report_progress]}))
+
+@contextmanager
+def borrow_ydl(job_dir, chat_id, message_id):
+    """Take a YoutubeDL from the pool, set up to download into job_dir"""
+    ydl = YDL_POOL.get()
+    ydl.params['outtmpl'] = {'default': str(job_dir / '%(id)s.%(ext)s')}
+    _job.status = (chat_id, message_id)
+    try:
+        yield ydl
+    finally:
+        _job.status = None
+        YDL_POOL.put(ydl)
 
 def download_video(url, message):
     """Download YouTube video and send to Telegram"""
     status_message = None
-    downloaded_file = None
-    processed_file = None
+    # Per-job directory so concurrent downloads don't touch each other's files
+    job_dir = Path(tempfile.mkdtemp(prefix='yt_', dir=DOWNLOAD_DIR))
     
     try:
         # Send initial status
         status_message = bot.reply_to(message, "📥 Starting download...")
         
-        # Configure yt-dlp options
-        ydl_opts = {
-            'format': 'bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[height<=1080][ext=mp4]/best[ext=mp4]/best',
-            'outtmpl': str(DOWNLOAD_DIR / '%(title)s.%(ext)s'),
-            'merge_output_format': 'mp4'
-        }
-        
-        # Clean up existing files
-        for file in DOWNLOAD_DIR.glob("*"):
-            try:
-                file.unlink()
-            except Exception as e:
-                logger.error(f"Error cleaning up file {file}: {e}")
-
         # Extract video information
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            bot.edit_message_text("⌛ Fetching video information...", 
-                                message.chat.id, 
-                                status_message.message_id)
+        with borrow_ydl(job_dir, message.chat.id, status_message.message_id) as ydl:
+            set_status(message.chat.id, status_message.message_id, "⌛ Fetching video information...")
             
-            info = ydl.extract_info(url, download=False)
+            info = get_video_info(ydl, url)
             if not info:
                 raise ValueError("Could not fetch video information")
 
@@ -121,70 +335,71 @@ def download_video(url, message):
             # Get safe filename
             title = info.get('title', 'video')
             safe_title = get_safe_filename(title)
-            downloaded_file = DOWNLOAD_DIR / f"{safe_title}_raw.mp4"
-            processed_file = DOWNLOAD_DIR / f"{safe_title}.mp4"
+            processed_file = job_dir / f"{safe_title}.mp4"
 
-            # Download video
-            bot.edit_message_text("⏳ Downloading video in 1080p...", 
-                                message.chat.id, 
-                                status_message.message_id)
-            
-            ydl.download([url])
-            
-            # Find the downloaded file
-            potential_files = list(DOWNLOAD_DIR.glob("*"))
-            if not potential_files:
-                raise FileNotFoundError("No files found in download directory")
-            
-            downloaded_file = max(potential_files, key=lambda x: x.stat().st_mtime)
-            
-            # Process video with FFmpeg
-            bot.edit_message_text("🎬 Processing video for better quality...", 
-                                message.chat.id, 
-                                status_message.message_id)
-            
-            if not process_video(str(downloaded_file), str(processed_file)):
-                raise ValueError("Failed to process video")
+            if is_h264_mp4(info):
+                # Download video
+                set_status(message.chat.id, status_message.message_id, "⏳ Downloading video in 1080p...")
+                
+                # Download from the fetched metadata instead of extracting again,
+                # progress is reported by the progress hook
+                info = ydl.process_ie_result(info, download=True)
+                
+                # yt-dlp reports exactly where it saved the video
+                downloaded_file = Path(info['requested_downloads'][0]['filepath'])
+
+                # Already H.264/AAC MP4, upload the download directly
+                processed_file = downloaded_file
+            else:
+                # Download and process video with FFmpeg in one go. The
+                # download happens inside the encode slot too, so the slots
+                # also cap concurrent re-encode downloads, and the progress
+                # hook doesn't see this download (it runs in a subprocess)
+                set_status(message.chat.id, status_message.message_id, "🎬 Downloading and processing video for better quality...")
+                
+                with ENCODE_SLOTS:
+                    if not process_video(info, str(processed_file)):
+                        raise ValueError("Failed to process video")
             
-            # Check file size
-            file_size = os.path.getsize(processed_file)
+            # Check file size (one stat, also tells us the file exists)
+            try:
+                file_size = processed_file.stat().st_size
+            except FileNotFoundError:
+                raise FileNotFoundError("Downloaded file not found") from None
             if file_size > 50 * 1024 * 1024:  # 50MB limit
                 raise ValueError("Processed video is too large for Telegram (>50MB). Try a shorter video.")
 
             # Upload to Telegram
-            bot.edit_message_text("📤 Uploading to Telegram...", 
-                                message.chat.id, 
-                                status_message.message_id)
+            set_status(message.chat.id, status_message.message_id, "📤 Uploading to Telegram...")
             
-            with open(processed_file, 'rb') as video_file:
-                bot.send_video(
-                    message.chat.id,
-                    video_file,
-                    caption=f"✅ {title}\n🎥 Enhanced 1080p quality",
-                    supports_streaming=True,
-                    timeout=60
-                )
+            send_kwargs = dict(
+                caption=f"✅ {title}\n🎥 Enhanced 1080p quality",
+                supports_streaming=True,
+                timeout=120
+            )
+            if LOCAL_BOT_API:
+                # The local server picks the file up from disk, no upload needed
+                bot.send_video(message.chat.id, f"file://{processed_file.resolve()}", **send_kwargs)
+            else:
+                with open(processed_file, 'rb') as video_file:
+                    # Name the upload after the title, not the on-disk <id>.mp4
+                    upload = telebot.types.InputFile(video_file, file_name=f"{safe_title or 'video'}.mp4")
+                    bot.send_video(message.chat.id, upload, **send_kwargs)
             
-            bot.edit_message_text("✅ Download and processing completed!", 
-                                message.chat.id, 
-                                status_message.message_id)
+            set_status(message.chat.id, status_message.message_id, "✅ Download and processing completed!")
 
     except Exception as e:
         error_message = f"An error occurred: {str(e)}"
         logger.error(error_message)
         if status_message:
-            bot.edit_message_text(f"❌ {error_message}", 
-                                message.chat.id, 
-                                status_message.message_id)
+            set_status(message.chat.id, status_message.message_id, f"❌ {error_message}")
 
     finally:
-        # Clean up files
-        for file in [downloaded_file, processed_file]:
-            if file and file.exists():
-                try:
-                    file.unlink()
-                except Exception as e:
-                    logger.error(f"Error removing file {file}: {e}")
+        # Clean up the job's files
+        shutil.rmtree(job_dir, ignore_errors=True)
+        if status_message:
+            with _status_lock:
+                _last_status.pop((message.chat.id, status_message.message_id), None)
 
 @bot.message_handler(commands=['start', 'help'])
 def send_welcome(message):
@@ -212,22 +427,44 @@ Simply paste a YouTube link to start downloading!
 @bot.message_handler(func=lambda message: message.text and is_valid_youtube_url(message.text))
 def handle_youtube_url(message):
     """Handle YouTube URLs"""
-    download_video(message.text, message)
+    # Only pass the link itself on, the message may contain other text
+    url = YOUTUBE_URL_RE.search(message.text).group(0)
+    EXEC.submit(download_video, url, message)
 
 @bot.message_handler(func=lambda message: True)
 def handle_invalid_message(message):
     """Handle all other messages"""
     bot.reply_to(message, "Please send a valid YouTube link! 🎥")
 
+@app.post(f"/{BOT_TOKEN}")
+def telegram_webhook():
+    """Receive updates pushed by Telegram"""
+    update = telebot.types.Update.de_json(request.get_json(force=True))
+    bot.process_new_updates([update])
+    return '', 200
+
+def set_webhook():
+    """Point Telegram at our webhook endpoint"""
+    if not PUBLIC_URL:
+        raise ValueError("No PUBLIC_URL found in environment variables!")
+    bot.remove_webhook()
+    bot.set_webhook(url=f"{PUBLIC_URL.rstrip('/')}/{BOT_TOKEN}")
+    logger.info("Webhook set, waiting for YouTube links...")
+
 def main():
     """Main function to run the bot"""
+    if PUBLIC_URL:
+        # Webhook mode: Telegram pushes updates as they arrive
+        set_webhook()
+        app.run(host='0.0.0.0', port=int(os.getenv('PORT', '8080')))
+        return
+
     logger.info("Bot started! Waiting for YouTube links...")
-    while True:
-        try:
-            bot.polling(none_stop=True, interval=1, timeout=60)
-        except Exception as e:
-            logger.error(f"Bot polling error: {e}")
-            continue
+    # getUpdates is refused while a webhook is registered
+    bot.remove_webhook()
+    # Long-poll: each getUpdates blocks server-side for up to 50s,
+    # infinity_polling takes care of reconnecting on errors
+    bot.infinity_polling(timeout=60, long_polling_timeout=50, interval=0)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,16 @@
+# Run with: gunicorn bot:app
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+# A single worker: handlers only queue jobs, and the bot's own pools
+# (BOT_WORKERS downloads, cpu//2 encodes) are per process
+workers = 1
+worker_class = 'gthread'
+threads = 4
+# Downloads and uploads can take a while
+timeout = 300
+
+def post_worker_init(worker):
+    """Register the webhook from the worker, so the master never imports bot"""
+    from bot import set_webhook
+    set_webhook()